@@ -5,20 +5,48 @@
 支持手机扫码离线提交数据，自动存储到本地SQLite数据库
 """
 
-from flask import Flask, request, render_template, jsonify, send_from_directory
+from flask import Flask, request, render_template, jsonify, send_from_directory, g, abort
+from flask.json.provider import DefaultJSONProvider
 import sqlite3
-import json
+import orjson
 import os
+import shutil
 from datetime import datetime
 import logging
+import queue
+import threading
+import time
+import uuid
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from werkzeug.datastructures import FileStorage
+from werkzeug.security import safe_join
 from werkzeug.utils import secure_filename
-import qrcode
+import segno
 from io import BytesIO
 import base64
+from functools import lru_cache
+
+class OrjsonProvider(DefaultJSONProvider):
+    """使用orjson序列化响应的Flask JSON提供器，请求解析仍使用标准库json"""
+
+    def dumps(self, obj, **kwargs):
+        # 与标准库json一致：允许None/数字等非字符串键，并按配置排序键；
+        # 日期交给Flask的default处理，保持原有的HTTP日期格式
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.config['SECRET_KEY'] = 'raspberry-pi-data-collector-2024'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# 经nginx转发的请求带有该请求头，此时上传文件交给nginx发送，客户端IP取自X-Real-IP
+# （见 config/nginx.conf）；直接访问5000端口的请求没有该头，仍由Flask处理
+X_ACCEL_HEADER = 'X-Accel-Uploads'
+X_ACCEL_UPLOADS_PREFIX = '/internal-uploads/'
 
 # 配置日志
 logging.basicConfig(
@@ -36,15 +64,151 @@ SUBMISSIONS_DIR = os.path.join(DATA_DIR, 'submissions')
 UPLOADS_DIR = os.path.join(DATA_DIR, 'uploads')
 DB_PATH = os.path.join(DATA_DIR, 'submissions.db')
 
+# 上传文件写盘时的缓冲区大小
+UPLOAD_BUFFER_SIZE = 256 * 1024
+
 # 确保目录存在
 for directory in [DATA_DIR, SUBMISSIONS_DIR, UPLOADS_DIR, os.path.join(DATA_DIR, 'logs')]:
     os.makedirs(directory, exist_ok=True)
 
+# 每个连接都要设置的SQLite参数
+SQLITE_PRAGMAS = (
+    'synchronous=NORMAL',
+    'temp_store=MEMORY',
+    'cache_size=-64000',  # 64MB页缓存
+    'mmap_size=268435456',  # 256MB内存映射
+)
+
+# 常用SQL语句，固定文本可命中SQLite语句缓存
+SQL_INSERT_SUBMISSION = '''
+    INSERT INTO submissions (form_type, data, files, ip_address, user_agent)
+    VALUES (?, ?, ?, ?, ?)
+'''
+SQL_INSERT_TASK = "INSERT INTO submission_tasks (task_id, status) VALUES (?, 'pending')"
+SQL_FINISH_TASK = '''
+    UPDATE submission_tasks SET status = ?, submission_id = ?, error = ?
+    WHERE task_id = ?
+'''
+SQL_SELECT_TASK = 'SELECT status, submission_id, error FROM submission_tasks WHERE task_id = ?'
+# 任务状态只保留一天
+SQL_PRUNE_TASKS = "DELETE FROM submission_tasks WHERE created_at < DATETIME('now', '-1 day')"
+SQL_SELECT_ALL = '''
+    SELECT id, timestamp, form_type, data, files, ip_address, synced_to_cloud
+    FROM submissions 
+    ORDER BY timestamp DESC
+'''
+
+class SqlitePool:
+    """线程安全的SQLite连接池，连接按需创建，最多保持n个"""
+
+    def __init__(self, n, path, timeout=30):
+        self.n = n
+        self.path = path
+        self.timeout = timeout
+        self._idle = queue.Queue(maxsize=n)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                               cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(f'PRAGMA {pragma}')
+        return conn
+
+    def _try_create(self):
+        """池未满时新建连接，池已满返回None"""
+        with self._lock:
+            if self._created >= self.n:
+                return None
+            self._created += 1
+        try:
+            return self._connect()
+        except Exception:
+            self._discard(None)
+            raise
+
+    def _discard(self, conn):
+        """丢弃损坏的连接，让出池中的名额"""
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        with self._lock:
+            self._created -= 1
+
+    def acquire(self):
+        """取出一个连接，池满时最多等待timeout秒，超时抛出RuntimeError"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+            conn = self._try_create()
+            if conn is not None:
+                return conn
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError('等待数据库连接超时')
+            # 分段等待，期间有连接被丢弃时可以重新创建
+            try:
+                return self._idle.get(timeout=min(remaining, 0.5))
+            except queue.Empty:
+                pass
+
+    def release(self, conn):
+        """归还连接，未结束的事务会被回滚，回滚失败的连接直接丢弃"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except Exception as e:
+            logging.error(f"回滚失败，丢弃数据库连接: {e}")
+            self._discard(conn)
+            return
+        self._idle.put_nowait(conn)
+
+    @contextmanager
+    def conn(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+def is_proxied_request():
+    """请求是否经nginx转发（nginx会覆盖客户端传入的同名头）"""
+    return request.headers.get(X_ACCEL_HEADER) == '1'
+
+def get_client_ip():
+    """获取客户端IP，经nginx转发时使用nginx设置的X-Real-IP"""
+    if is_proxied_request():
+        return request.headers.get('X-Real-IP', request.remote_addr)
+    return request.remote_addr
+
+def get_db():
+    """获取当前请求的数据库连接，同一请求内复用"""
+    if 'db' not in g:
+        g.db = POOL.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def close_db(exception=None):
+    """请求结束时把数据库连接归还连接池"""
+    db = g.pop('db', None)
+    if db is not None:
+        POOL.release(db)
+
 def init_database():
     """初始化数据库"""
     conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
     
+    # WAL模式是持久化的，只需在初始化时设置一次
+    cursor.execute('PRAGMA journal_mode=WAL')
+    
     # 创建数据提交表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS submissions (
@@ -60,6 +224,27 @@ def init_database():
         )
     ''')
     
+    # 索引：未同步数据（部分索引）、按类型统计、按时间查询
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_unsynced
+        ON submissions(synced_to_cloud, timestamp)
+        WHERE synced_to_cloud = FALSE
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_form_type ON submissions(form_type)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_timestamp ON submissions(timestamp)')
+    
+    # 创建后台保存任务表（各gunicorn worker共享任务状态）
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS submission_tasks (
+            task_id VARCHAR(32) PRIMARY KEY,
+            status VARCHAR(10),
+            submission_id INTEGER NULL,
+            error TEXT NULL,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_task_created ON submission_tasks(created_at)')
+    
     # 创建系统日志表
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS system_logs (
@@ -75,46 +260,137 @@ def init_database():
     conn.close()
     logging.info("数据库初始化完成")
 
-def save_submission(form_type, data, files=None, ip_address=None, user_agent=None):
-    """保存提交的数据到数据库"""
-    conn = sqlite3.connect(DB_PATH)
+# 数据库连接池，大小按树莓派核心数取 min(8, cpu*2)
+POOL_SIZE = min(8, (os.cpu_count() or 1) * 2)
+POOL = SqlitePool(POOL_SIZE, DB_PATH)
+
+def save_submission(form_type, data, files=None, ip_address=None, user_agent=None, conn=None):
+    """保存提交的数据到数据库，conn为空时使用当前请求的连接"""
+    if conn is None:
+        conn = get_db()
     cursor = conn.cursor()
     
     # 处理文件信息
     file_info = []
     if files:
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         for file in files:
             if file.filename:
                 filename = secure_filename(file.filename)
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
                 safe_filename = f"{timestamp}_{filename}"
                 file_path = os.path.join(UPLOADS_DIR, safe_filename)
-                file.save(file_path)
+                with open(file_path, 'wb') as out:
+                    shutil.copyfileobj(file.stream, out, length=UPLOAD_BUFFER_SIZE)
+                    size = out.tell()
                 file_info.append({
                     'original_name': filename,
                     'saved_name': safe_filename,
                     'path': file_path,
-                    'size': os.path.getsize(file_path)
+                    'size': size
                 })
     
-    cursor.execute('''
-        INSERT INTO submissions (form_type, data, files, ip_address, user_agent)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (
+    cursor.execute(SQL_INSERT_SUBMISSION, (
         form_type,
-        json.dumps(data, ensure_ascii=False),
-        json.dumps(file_info, ensure_ascii=False) if file_info else None,
+        orjson.dumps(data).decode('utf-8'),
+        orjson.dumps(file_info).decode('utf-8') if file_info else None,
         ip_address,
         user_agent
     ))
     
     submission_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
     
     logging.info(f"数据提交成功，ID: {submission_id}")
     return submission_id
 
+# 后台写入线程：文件写盘和数据库插入不阻塞请求
+# 任务状态存放在submission_tasks表中，多个gunicorn worker都能查询
+WRITER = ThreadPoolExecutor(max_workers=2, thread_name_prefix='submission-writer')
+# 每个进程最多积压的保存任务数（每个最多占用MAX_CONTENT_LENGTH内存），满了返回503
+MAX_PENDING_SAVES = 4
+WRITER_SLOTS = threading.BoundedSemaphore(MAX_PENDING_SAVES)
+
+def _finish_task(conn, task_id, status, submission_id=None, error=None):
+    """记录后台保存任务的最终状态"""
+    conn.execute(SQL_FINISH_TASK, (status, submission_id, error, task_id))
+
+def _do_save(task_id, form_type, data, files, ip_address, user_agent):
+    """在后台线程中保存提交，并记录任务结果；结束后释放积压名额"""
+    try:
+        with POOL.conn() as conn:
+            # 提交记录和任务状态在同一事务中写入，任务为done时记录一定存在
+            conn.execute('BEGIN')
+            try:
+                submission_id = save_submission(
+                    form_type=form_type,
+                    data=data,
+                    files=files,
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                    conn=conn
+                )
+                _finish_task(conn, task_id, 'done', submission_id=submission_id)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return submission_id
+    except Exception as e:
+        logging.error(f"后台保存失败 (任务 {task_id}): {e}")
+        try:
+            with POOL.conn() as conn:
+                _finish_task(conn, task_id, 'failed', error=str(e))
+        except Exception as record_error:
+            logging.error(f"记录任务状态失败 (任务 {task_id}): {record_error}")
+        return None
+    finally:
+        WRITER_SLOTS.release()
+
+def submit_save_task(form_type, data, files=None, ip_address=None, user_agent=None):
+    """把保存任务交给后台线程，返回任务ID；调用前须已取得WRITER_SLOTS名额"""
+    task_id = uuid.uuid4().hex
+    conn = get_db()
+    conn.execute(SQL_PRUNE_TASKS)
+    conn.execute(SQL_INSERT_TASK, (task_id,))
+    WRITER.submit(_do_save, task_id, form_type, data, files, ip_address, user_agent)
+    return task_id
+
+# form_type 列为 VARCHAR(50)
+MAX_FORM_TYPE_LENGTH = 50
+
+def is_valid_batch_record(record):
+    """检查批量提交中的单条记录：form_type为不超过50字符的字符串，data为对象"""
+    if not isinstance(record, dict):
+        return False
+    form_type = record.get('form_type', 'general')
+    data = record.get('data', {})
+    return (isinstance(form_type, str) and len(form_type) <= MAX_FORM_TYPE_LENGTH
+            and isinstance(data, dict))
+
+def save_submissions_bulk(records, ip_address=None, user_agent=None):
+    """在单个事务中批量保存多条提交（不含文件）"""
+    rows = [
+        (
+            record.get('form_type', 'general'),
+            orjson.dumps(record.get('data', {})).decode('utf-8'),
+            None,
+            ip_address,
+            user_agent
+        )
+        for record in records
+    ]
+    
+    conn = get_db()
+    conn.execute('BEGIN')
+    try:
+        conn.executemany(SQL_INSERT_SUBMISSION, rows)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    logging.info(f"批量数据提交成功，共 {len(rows)} 条")
+    return len(rows)
+
 @app.route('/')
 def index():
     """主页 - 显示数据提交表单和二维码"""
@@ -137,30 +413,115 @@ def submit_data():
             if key != 'form_type':
                 form_data[key] = value
         
-        # 获取上传的文件
-        files = []
-        for key, file in request.files.items():
-            if file.filename:
-                files.append(file)
+        # 后台积压已满时拒绝，避免文件堆积在内存中
+        if not WRITER_SLOTS.acquire(blocking=False):
+            return jsonify({
+                'success': False,
+                'message': '服务器繁忙，请稍后重试'
+            }), 503
+        
+        queued = False
+        try:
+            # 获取上传的文件，读入内存后交给后台线程（大小受MAX_CONTENT_LENGTH限制）
+            files = []
+            for key, file in request.files.items():
+                if file.filename:
+                    files.append(FileStorage(
+                        stream=BytesIO(file.stream.read()),
+                        filename=file.filename
+                    ))
+            
+            # 后台保存到数据库
+            task_id = submit_save_task(
+                form_type=form_type,
+                data=form_data,
+                files=files if files else None,
+                ip_address=get_client_ip(),
+                user_agent=request.headers.get('User-Agent')
+            )
+            queued = True
+        finally:
+            if not queued:
+                WRITER_SLOTS.release()
+        
+        return jsonify({
+            'success': True,
+            'message': '数据已接收',
+            'task_id': task_id,
+            'timestamp': datetime.now().isoformat()
+        }), 202
+        
+    except Exception as e:
+        logging.error(f"数据提交失败: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'提交失败: {str(e)}'
+        }), 500
+
+@app.route('/api/submit/<task_id>')
+def submit_status(task_id):
+    """查询后台保存任务的状态"""
+    try:
+        task = get_db().execute(SQL_SELECT_TASK, (task_id,)).fetchone()
+    except Exception as e:
+        logging.error(f"查询任务状态失败: {str(e)}")
+        return jsonify({
+            'success': False,
+            'message': f'查询任务状态失败: {str(e)}'
+        }), 500
+    
+    if task is None:
+        return jsonify({
+            'success': False,
+            'message': '任务不存在'
+        }), 404
+    if task['status'] == 'pending':
+        return jsonify({'success': True, 'status': 'pending'})
+    if task['status'] == 'failed':
+        return jsonify({
+            'success': False,
+            'status': 'failed',
+            'message': f"提交失败: {task['error']}"
+        })
+    return jsonify({
+        'success': True,
+        'status': 'done',
+        'submission_id': task['submission_id']
+    })
+
+@app.route('/api/submit_batch', methods=['POST'])
+def submit_batch():
+    """API接口 - 批量接收数据提交（JSON数组）"""
+    try:
+        records = request.get_json(silent=True)
+        if not isinstance(records, list) or not all(is_valid_batch_record(r) for r in records):
+            return jsonify({
+                'success': False,
+                'message': '请求体必须是JSON对象数组，form_type为不超过50字符的字符串，data为对象'
+            }), 400
         
-        # 保存到数据库
-        submission_id = save_submission(
-            form_type=form_type,
-            data=form_data,
-            files=files if files else None,
-            ip_address=request.remote_addr,
+        count = save_submissions_bulk(
+            records,
+            ip_address=get_client_ip(),
             user_agent=request.headers.get('User-Agent')
         )
         
         return jsonify({
             'success': True,
-            'message': '数据提交成功',
-            'submission_id': submission_id,
+            'message': '批量数据提交成功',
+            'count': count,
             'timestamp': datetime.now().isoformat()
         })
         
+    except orjson.JSONEncodeError as e:
+        # 例如超出64位范围的整数，orjson无法存储
+        return jsonify({
+            'success': False,
+            'message': f'数据无法保存: {str(e)}'
+        }), 400
+        
     except Exception as e:
-        logging.error(f"数据提交失败: {str(e)}")
+        logging.error(f"批量数据提交失败: {str(e)}")
         return jsonify({
             'success': False,
             'message': f'提交失败: {str(e)}'
@@ -170,29 +531,23 @@ def submit_data():
 def get_submissions():
     """获取所有提交的数据"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT id, timestamp, form_type, data, files, ip_address, synced_to_cloud
-            FROM submissions 
-            ORDER BY timestamp DESC
-        ''')
+        rows = cursor.execute(SQL_SELECT_ALL).fetchall()
         
-        submissions = []
-        for row in cursor.fetchall():
-            submission = {
-                'id': row[0],
-                'timestamp': row[1],
-                'form_type': row[2],
-                'data': json.loads(row[3]) if row[3] else {},
-                'files': json.loads(row[4]) if row[4] else [],
-                'ip_address': row[5],
-                'synced_to_cloud': bool(row[6])
+        submissions = [
+            {
+                'id': row['id'],
+                'timestamp': row['timestamp'],
+                'form_type': row['form_type'],
+                'data': orjson.loads(row['data']) if row['data'] else {},
+                'files': orjson.loads(row['files']) if row['files'] else [],
+                'ip_address': row['ip_address'],
+                'synced_to_cloud': bool(row['synced_to_cloud'])
             }
-            submissions.append(submission)
-        
-        conn.close()
+            for row in rows
+        ]
         
         return jsonify({
             'success': True,
@@ -207,34 +562,28 @@ def get_submissions():
             'message': f'获取数据失败: {str(e)}'
         }), 500
 
+# 二维码访问地址
+QR_URL = "http://192.168.150.24:5000"
+
+@lru_cache(maxsize=None)
+def build_qrcode_data_uri(url):
+    """生成二维码PNG的base64 data URI，结果按URL缓存"""
+    qr = segno.make(url, error='m', micro=False)
+    
+    # 转换为base64
+    buffer = BytesIO()
+    qr.save(buffer, kind='png', scale=10, border=5)
+    img_str = base64.b64encode(buffer.getvalue()).decode()
+    return f"data:image/png;base64,{img_str}"
+
 @app.route('/api/qrcode')
 def generate_qrcode():
     """生成访问二维码"""
     try:
-        # 获取树莓派的IP地址
-        import socket
-        hostname = socket.gethostname()
-        local_ip = socket.gethostbyname(hostname)
-        
-        # 生成访问URL
-        url = f"http://192.168.150.24:5000"
-        
-        # 生成二维码
-        qr = qrcode.QRCode(version=1, box_size=10, border=5)
-        qr.add_data(url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # 转换为base64
-        buffer = BytesIO()
-        img.save(buffer, format='PNG')
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        
         return jsonify({
             'success': True,
-            'qrcode': f"data:image/png;base64,{img_str}",
-            'url': url
+            'qrcode': build_qrcode_data_uri(QR_URL),
+            'url': QR_URL
         })
         
     except Exception as e:
@@ -247,6 +596,15 @@ def generate_qrcode():
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """提供上传文件的访问"""
+    if is_proxied_request():
+        file_path = safe_join(UPLOADS_DIR, filename)
+        if file_path is None or not os.path.isfile(file_path):
+            abort(404)
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = X_ACCEL_UPLOADS_PREFIX + quote(filename)
+        # 由nginx根据文件扩展名设置Content-Type
+        del response.headers['Content-Type']
+        return response
     return send_from_directory(UPLOADS_DIR, filename)
 
 @app.route('/admin')
@@ -258,23 +616,19 @@ def admin_panel():
 def get_stats():
     """获取系统统计信息"""
     try:
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         cursor = conn.cursor()
         
-        # 总提交数
-        cursor.execute('SELECT COUNT(*) FROM submissions')
-        total_submissions = cursor.fetchone()[0]
-        
-        # 今日提交数
-        cursor.execute('''
-            SELECT COUNT(*) FROM submissions 
-            WHERE DATE(timestamp) = DATE('now')
-        ''')
-        today_submissions = cursor.fetchone()[0]
-        
-        # 未同步数
-        cursor.execute('SELECT COUNT(*) FROM submissions WHERE synced_to_cloud = FALSE')
-        unsynced_count = cursor.fetchone()[0]
+        # 总提交数、今日提交数、未同步数（一次扫描）
+        row = cursor.execute('''
+            SELECT COUNT(*) AS total,
+                   COALESCE(SUM(timestamp >= DATE('now') AND timestamp < DATE('now', '+1 day')), 0) AS today,
+                   COALESCE(SUM(synced_to_cloud = FALSE), 0) AS unsynced
+            FROM submissions
+        ''').fetchone()
+        total_submissions = row['total']
+        today_submissions = row['today']
+        unsynced_count = row['unsynced']
         
         # 按类型统计
         cursor.execute('''
@@ -282,9 +636,7 @@ def get_stats():
             FROM submissions 
             GROUP BY form_type
         ''')
-        type_stats = dict(cursor.fetchall())
-        
-        conn.close()
+        type_stats = {row[0]: row[1] for row in cursor.fetchall()}
         
         return jsonify({
             'success': True,
@@ -303,6 +655,10 @@ def get_stats():
             'message': f'获取统计信息失败: {str(e)}'
         }), 500
 
-if __name__ == '__main__':
+def create_app():
+    """应用工厂，gunicorn预加载时只在主进程执行一次"""
     init_database()
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    return app
+
+if __name__ == '__main__':
+    create_app().run(host='0.0.0.0', port=5000, debug=False)
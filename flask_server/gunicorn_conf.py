@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+Gunicorn配置 - 树莓派4B（4核）
+启动: gunicorn -c gunicorn_conf.py "app:create_app()"
+"""
+
+# 二维码直接指向5000端口，因此不只监听本机；经nginx转发的请求另有X-Accel-Uploads头区分
+bind = '0.0.0.0:5000'
+workers = 4
+worker_class = 'gthread'
+threads = 2
+timeout = 30
+preload_app = True
+
+def post_fork(server, worker):
+    """每个worker使用自己的数据库连接池，避免跨进程共享连接
+    后台保存任务的状态存放在SQLite中，任意worker都能查询"""
+    import app
+    app.POOL = app.SqlitePool(app.POOL_SIZE, app.DB_PATH)
@@ -6,14 +6,19 @@
 """
 
 import sqlite3
-import json
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
 import logging
 import os
 from datetime import datetime
 import hashlib
-import subprocess
+import hmac
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # 配置
 CONFIG = {
@@ -22,10 +27,27 @@ CONFIG = {
     'config_path': '/home/pi/data/config/cloud_config.json',
     'api_base_url': 'https://api.cli.im',  # 草料二维码API
     'max_retries': 3,
-    'retry_delay': 5,  # 秒
+    'retry_backoff': 0.5,  # 重试退避系数（秒），按指数增长
     'batch_size': 10,  # 每批同步数量
+    'sync_workers': 4,  # 并发同步线程数
+    'rate_limit': 4,  # 每秒最多请求数，避免API限流
+    'config_save_interval': 60,  # 最后同步时间至少间隔多少秒才写回配置文件
 }
 
+# 常用SQL语句
+SQL_SELECT_UNSYNCED = '''
+    SELECT id, timestamp, form_type, data, files, ip_address
+    FROM submissions 
+    WHERE synced_to_cloud = FALSE
+    ORDER BY timestamp ASC
+    LIMIT ?
+'''
+SQL_MARK_SYNCED = '''
+    UPDATE submissions 
+    SET synced_to_cloud = TRUE, sync_timestamp = CURRENT_TIMESTAMP
+    WHERE id = ?
+'''
+
 # 配置日志
 logging.basicConfig(
     level=logging.INFO,
@@ -36,21 +58,64 @@ logging.basicConfig(
     ]
 )
 
+class RateLimiter:
+    """简单限速器：保证相邻两次请求间隔不小于 1/rate 秒"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
 class CloudSyncManager:
     def __init__(self):
+        self._saved_config = None  # 上次写入配置文件的内容，用于跳过重复写入
         self.config = self.load_config()
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'RaspberryPi-DataCollector/1.0',
             'Content-Type': 'application/json'
         })
+        # 连接池与重试交给urllib3处理
+        retry = Retry(
+            total=CONFIG['max_retries'],
+            backoff_factor=CONFIG['retry_backoff'],
+            status_forcelist=(429, 502, 503, 504),
+            allowed_methods=frozenset({'POST'}),
+            raise_on_status=False
+        )
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=16,
+            max_retries=retry
+        ))
+        self.rate_limiter = RateLimiter(CONFIG['rate_limit'])
+        self._device_info = {
+            'hostname': os.uname().nodename,
+            'platform': 'raspberry_pi_4b'
+        }
+        # 整个同步过程复用同一个数据库连接
+        self._conn = sqlite3.connect(CONFIG['db_path'], isolation_level=None,
+                                     check_same_thread=False)
+        for pragma in ('journal_mode=WAL', 'synchronous=NORMAL', 'temp_store=MEMORY'):
+            self._conn.execute(f'PRAGMA {pragma}')
         
     def load_config(self):
         """加载云端配置"""
         try:
             if os.path.exists(CONFIG['config_path']):
-                with open(CONFIG['config_path'], 'r', encoding='utf-8') as f:
-                    return json.load(f)
+                with open(CONFIG['config_path'], 'rb') as f:
+                    content = f.read()
+                config = orjson.loads(content)
+                self._saved_config = orjson.dumps(config, option=orjson.OPT_INDENT_2)
+                return config
             else:
                 # 创建默认配置
                 default_config = {
@@ -68,37 +133,38 @@ class CloudSyncManager:
             return {}
     
     def save_config(self, config):
-        """保存配置"""
+        """保存配置（内容未变化时不写入，写临时文件后原子替换）"""
         try:
+            content = orjson.dumps(config, option=orjson.OPT_INDENT_2)
+            if content == self._saved_config:
+                return
+            
             os.makedirs(os.path.dirname(CONFIG['config_path']), exist_ok=True)
-            with open(CONFIG['config_path'], 'w', encoding='utf-8') as f:
-                json.dump(config, f, ensure_ascii=False, indent=2)
+            tmp_path = CONFIG['config_path'] + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, CONFIG['config_path'])
+            self._saved_config = content
         except Exception as e:
             logging.error(f"保存配置失败: {e}")
     
     def check_network_connection(self):
         """检查网络连接"""
         try:
-            # 检查是否能连接到互联网
-            response = subprocess.run(['ping', '-c', '1', '8.8.8.8'], 
-                                   capture_output=True, timeout=10)
-            return response.returncode == 0
-        except:
+            # 检查是否能连接到互联网（TCP连接公共DNS，无需启动ping进程）
+            with socket.create_connection(('8.8.8.8', 53), timeout=2):
+                return True
+        except OSError:
             return False
     
     def get_unsynced_submissions(self):
         """获取未同步的数据"""
         try:
-            conn = sqlite3.connect(CONFIG['db_path'])
-            cursor = conn.cursor()
+            cursor = self._conn.cursor()
             
-            cursor.execute('''
-                SELECT id, timestamp, form_type, data, files, ip_address
-                FROM submissions 
-                WHERE synced_to_cloud = FALSE
-                ORDER BY timestamp ASC
-                LIMIT ?
-            ''', (CONFIG['batch_size'],))
+            cursor.execute(SQL_SELECT_UNSYNCED, (CONFIG['batch_size'],))
             
             submissions = []
             for row in cursor.fetchall():
@@ -106,13 +172,12 @@ class CloudSyncManager:
                     'id': row[0],
                     'timestamp': row[1],
                     'form_type': row[2],
-                    'data': json.loads(row[3]) if row[3] else {},
-                    'files': json.loads(row[4]) if row[4] else [],
+                    'data': orjson.loads(row[3]) if row[3] else {},
+                    'files': orjson.loads(row[4]) if row[4] else [],
                     'ip_address': row[5]
                 }
                 submissions.append(submission)
             
-            conn.close()
             return submissions
             
         except Exception as e:
@@ -126,9 +191,11 @@ class CloudSyncManager:
             if not api_secret:
                 return None
                 
-            # 创建签名字符串
-            sign_string = f"{json.dumps(data, sort_keys=True)}{timestamp}{api_secret}"
-            return hashlib.md5(sign_string.encode('utf-8')).hexdigest()
+            # HMAC-SHA256(api_secret, 排序后的JSON + 时间戳)
+            h = hmac.new(api_secret.encode('utf-8'), digestmod=hashlib.sha256)
+            h.update(orjson.dumps(data, option=orjson.OPT_SORT_KEYS))
+            h.update(str(timestamp).encode('utf-8'))
+            return h.hexdigest()
         except Exception as e:
             logging.error(f"生成签名失败: {e}")
             return None
@@ -136,7 +203,9 @@ class CloudSyncManager:
     def sync_to_cloud(self, submission):
         """同步单条数据到云端"""
         try:
-            if not self.config.get('api_key') or not self.config.get('api_secret'):
+            api_key = self.config.get('api_key')
+            api_secret = self.config.get('api_secret')
+            if not (api_key and api_secret):
                 logging.warning("未配置API密钥，跳过云端同步")
                 return False
             
@@ -148,10 +217,7 @@ class CloudSyncManager:
                 'form_type': submission['form_type'],
                 'data': submission['data'],
                 'ip_address': submission['ip_address'],
-                'device_info': {
-                    'hostname': os.uname().nodename,
-                    'platform': 'raspberry_pi_4b'
-                }
+                'device_info': self._device_info
             }
             
             # 添加文件信息（不上传实际文件，只记录文件信息）
@@ -175,35 +241,32 @@ class CloudSyncManager:
             
             # 准备API请求
             api_data = {
-                'api_key': self.config['api_key'],
+                'api_key': api_key,
                 'timestamp': timestamp,
                 'signature': signature,
                 'data': sync_data
             }
             
-            # 发送到云端
-            for attempt in range(CONFIG['max_retries']):
-                try:
-                    response = self.session.post(
-                        f"{CONFIG['api_base_url']}/data/submit",
-                        json=api_data,
-                        timeout=30
-                    )
-                    
-                    if response.status_code == 200:
-                        result = response.json()
-                        if result.get('success'):
-                            logging.info(f"数据同步成功: ID {submission['id']}")
-                            return True
-                        else:
-                            logging.error(f"云端返回错误: {result.get('message')}")
+            # 发送到云端（失败重试由HTTPAdapter处理）
+            try:
+                response = self.session.post(
+                    f"{CONFIG['api_base_url']}/data/submit",
+                    data=orjson.dumps(api_data),
+                    timeout=30
+                )
+                
+                if response.status_code == 200:
+                    result = response.json()
+                    if result.get('success'):
+                        logging.info(f"数据同步成功: ID {submission['id']}")
+                        return True
                     else:
-                        logging.error(f"HTTP错误: {response.status_code}")
-                        
-                except requests.exceptions.RequestException as e:
-                    logging.error(f"网络请求失败 (尝试 {attempt + 1}/{CONFIG['max_retries']}): {e}")
-                    if attempt < CONFIG['max_retries'] - 1:
-                        time.sleep(CONFIG['retry_delay'])
+                        logging.error(f"云端返回错误: {result.get('message')}")
+                else:
+                    logging.error(f"HTTP错误: {response.status_code}")
+                    
+            except requests.exceptions.RequestException as e:
+                logging.error(f"网络请求失败: {e}")
             
             return False
             
@@ -211,22 +274,26 @@ class CloudSyncManager:
             logging.error(f"同步数据失败: {e}")
             return False
     
-    def mark_as_synced(self, submission_id):
-        """标记数据为已同步"""
+    def _rate_limited_sync(self, submission):
+        """限速后同步单条数据（在线程池中执行）"""
+        self.rate_limiter.wait()
+        return self.sync_to_cloud(submission)
+    
+    def mark_as_synced(self, submission_ids):
+        """批量标记数据为已同步（单个事务）"""
+        if not submission_ids:
+            return
+        
+        conn = self._conn
         try:
-            conn = sqlite3.connect(CONFIG['db_path'])
-            cursor = conn.cursor()
-            
-            cursor.execute('''
-                UPDATE submissions 
-                SET synced_to_cloud = TRUE, sync_timestamp = CURRENT_TIMESTAMP
-                WHERE id = ?
-            ''', (submission_id,))
-            
+            conn.execute('BEGIN')
+            conn.executemany(SQL_MARK_SYNCED,
+                             [(submission_id,) for submission_id in submission_ids])
             conn.commit()
-            conn.close()
             
         except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
             logging.error(f"标记同步状态失败: {e}")
     
     def sync_all_pending(self):
@@ -246,27 +313,45 @@ class CloudSyncManager:
             logging.info("没有待同步数据")
             return True
         
-        success_count = 0
+        synced_ids = []
         total_count = len(submissions)
         
-        for submission in submissions:
-            if self.sync_to_cloud(submission):
-                self.mark_as_synced(submission['id'])
-                success_count += 1
-            else:
-                logging.error(f"同步失败: ID {submission['id']}")
-            
-            # 避免API限流
-            time.sleep(1)
+        with ThreadPoolExecutor(max_workers=CONFIG['sync_workers']) as executor:
+            futures = {
+                executor.submit(self._rate_limited_sync, submission): submission
+                for submission in submissions
+            }
+            for future in as_completed(futures):
+                submission = futures[future]
+                if future.result():
+                    synced_ids.append(submission['id'])
+                else:
+                    logging.error(f"同步失败: ID {submission['id']}")
+        
+        self.mark_as_synced(synced_ids)
+        success_count = len(synced_ids)
         
         logging.info(f"同步完成: {success_count}/{total_count} 成功")
         
-        # 更新最后同步时间
-        self.config['last_sync_time'] = datetime.now().isoformat()
-        self.save_config(self.config)
+        # 更新最后同步时间（间隔太短时不写回，减少SD卡写入）
+        now = datetime.now()
+        last_sync_time = self.config.get('last_sync_time')
+        try:
+            elapsed = (now - datetime.fromisoformat(last_sync_time)).total_seconds()
+        except (TypeError, ValueError):
+            elapsed = None
+        # elapsed为负说明系统时钟曾被回拨（树莓派无RTC，NTP校时前时间可能偏早），也要写回
+        if elapsed is None or elapsed < 0 or elapsed >= CONFIG['config_save_interval']:
+            self.config['last_sync_time'] = now.isoformat()
+            self.save_config(self.config)
         
         return success_count == total_count
     
+    def close(self):
+        """关闭数据库连接和HTTP会话"""
+        self._conn.close()
+        self.session.close()
+    
     def create_qr_code_for_data(self, submission):
         """为数据创建二维码（草料二维码服务）"""
         try:
@@ -335,6 +420,8 @@ def main():
         logging.info("用户中断同步")
     except Exception as e:
         logging.error(f"同步过程出错: {e}")
+    finally:
+        sync_manager.close()
     
     logging.info("=== 云端同步服务结束 ===")
 
@@ -30,7 +30,7 @@ apt install -y python3-pip python3-venv python3-flask python3-sqlite3 \
 
 # 安装Python依赖
 echo "3. 安装Python依赖..."
-pip3 install flask qrcode[pil] requests pillow
+pip3 install flask gunicorn segno orjson requests
 
 # 创建数据目录
 echo "4. 创建数据目录..."
@@ -51,7 +51,7 @@ After=network.target
 Type=simple
 User=$REAL_USER
 WorkingDirectory=$USER_HOME/shumeipai/flask_server
-ExecStart=/usr/bin/python3 app.py
+ExecStart=/usr/bin/python3 -m gunicorn -c gunicorn_conf.py "app:create_app()"
 Restart=always
 RestartSec=10
 Environment=PYTHONPATH=$USER_HOME/shumeipai/flask_server